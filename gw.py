@@ -1,15 +1,25 @@
 import asyncio
+import atexit
+import heapq
+import itertools
+import math
 import os
 import random
-from collections import defaultdict
+import sys
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict
 
-from pyrogram import Client, filters, enums
-from pyrogram.types import Message
+import httpx
+from pyrogram import Client, ContinuePropagation, filters, enums, raw
+from pyrogram.types import InputMediaPhoto, Message
 from pyrogram.errors import FloodWait
 
-from gemini_webapi import GeneratedImage, WebImage
+from gemini_webapi import GeminiClient, GeneratedImage, WebImage
 
 from utils.db import db
 from utils.misc import modules_help, prefix
@@ -21,64 +31,897 @@ os.makedirs(TEMP_FILE_DIR, exist_ok=True)
 GWEB_HISTORY_COLLECTION = "custom.gweb"
 GWEB_SETTINGS = "custom.gweb_settings"
 DEFAULT_HISTORY_COMBINE_SECONDS = 8
+WHEEL_TICK = 0.1
+WHEEL_SLOTS = 512
+COALESCE_MIN_SECONDS = 1.5
+COALESCE_INITIAL_GAP = 3.0
+COALESCE_BURST_GAP = 60
+COALESCE_GAP_ALPHA = 0.3
+COALESCE_TYPING_HOLD = 6.0
+COALESCE_MAX_HOLD = 30.0
+USER_STATE_LIMIT = 10000
+USER_STATE_IDLE_SECONDS = 6 * 3600
+RECENT_UPDATE_TTL_SECONDS = 900
+RECENT_UPDATE_LIMIT = 20000
+REPLY_GLOBAL_RATE = 0.5
+REPLY_CHAT_INTERVAL = 1.1
+REPLY_LANE_IDLE_SECONDS = 30
+PRESENCE_REFRESH_SECONDS = 4.5
+PRESENCE_RETRY_SECONDS = 1.0
+GEMINI_MAX_CONCURRENCY = 4
+GEMINI_QUEUE_LIMIT = 20
+GEMINI_SHED_TEXT = "I'm getting a lot of messages right now, please write again in a few minutes."
+PRIORITY_ENABLED = 0
+PRIORITY_STRANGER = 1
+PACE_GLOBAL_MIN_RATE = 0.2
+PACE_GLOBAL_MAX_RATE = 3.0
+PACE_GLOBAL_STEP = 0.02
+PACE_CHAT_MIN_RATE = 0.1
+PACE_CHAT_MAX_RATE = 1.0
+PACE_CHAT_STEP = 0.05
+PACE_BACKOFF = 0.5
+PACE_CHAT_MEMORY_SECONDS = 600
+PACE_ACCOUNT_FLOOD_WINDOW = 60
+PACE_HISTORY_SIZE = 20
+GEM_CATALOG_TTL_SECONDS = 600
+POOL_MAIN_ACCOUNT = "main"
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_BACKOFF_BASE = 15
+BREAKER_BACKOFF_MAX = 900
+CHAT_SESSION_CACHE_SIZE = 200
+CHAT_SESSION_IDLE_SECONDS = 1800
+PERSIST_FLUSH_SECONDS = 5
+PERSIST_MAX_DIRTY = 100
+STREAM_EDIT_INTERVAL = 1.5
+TELEGRAM_TEXT_LIMIT = 4096
+TELEGRAM_CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+IMAGE_SPILL_BYTES = 8 * 1024 * 1024
+MEDIA_CACHE_DIR = os.path.join(TEMP_FILE_DIR, "gweb_cache")
+MEDIA_CACHE_MAX_BYTES = 512 * 1024 * 1024
+MEDIA_DOWNLOAD_CONCURRENCY = 4
+MEDIA_GROUP_TAIL_MIN = 0.5
+MEDIA_GROUP_TAIL_MAX = 3.0
+MEDIA_GROUP_TAIL_FACTOR = 3.0
+MEDIA_GROUP_GAP_ALPHA = 0.2
+
+_MISSING = object()
+_REMOVED = object()
+
+
+class _AsyncDb:
+    def __init__(self):
+        self.enabled = bool(db.get(GWEB_SETTINGS, "db_async", True))
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def set_enabled(self, enabled: bool):
+        self.enabled = enabled
+        db.set(GWEB_SETTINGS, "db_async", enabled)
+
+    async def run(self, func, *args):
+        if not self.enabled:
+            return func(*args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gweb-db")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, collection: str, key: str, default=None):
+        return await self.run(db.get, collection, key, default)
+
+
+_adb = _AsyncDb()
+
+
+class _WriteBehindStore:
+    def __init__(self, max_dirty: int):
+        self.interval = db.get(GWEB_SETTINGS, "persist_interval", PERSIST_FLUSH_SECONDS)
+        self.max_dirty = max_dirty
+        self._dirty: Dict[tuple, Any] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def _cached(self, collection: str, key: str, default):
+        value = self._dirty.get((collection, key), _MISSING)
+        if value is _REMOVED:
+            return default
+        return value
+
+    def get(self, collection: str, key: str, default=None):
+        value = self._cached(collection, key, default)
+        if value is not _MISSING:
+            return value
+        return db.get(collection, key, default)
+
+    async def aget(self, collection: str, key: str, default=None):
+        value = self._cached(collection, key, default)
+        if value is not _MISSING:
+            return value
+        return await _adb.get(collection, key, default)
+
+    def set(self, collection: str, key: str, value):
+        self._mark((collection, key), value)
+
+    def remove(self, collection: str, key: str):
+        self._mark((collection, key), _REMOVED)
+
+    def set_interval(self, seconds: float):
+        self.interval = seconds
+        self.set(GWEB_SETTINGS, "persist_interval", seconds)
+
+    def _mark(self, dirty_key: tuple, value):
+        self._dirty[dirty_key] = value
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self.interval <= 0 or len(self._dirty) >= self.max_dirty:
+            loop.create_task(self._flush_batch())
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(self.interval if self.interval > 0 else PERSIST_FLUSH_SECONDS)
+            await self._flush_batch()
+
+    async def _flush_batch(self):
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        failed = await _adb.run(self._write, dirty)
+        for dirty_key, value in failed.items():
+            self._dirty.setdefault(dirty_key, value)
+        if failed and (self._flusher is None or self._flusher.done()):
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    @staticmethod
+    def _write(batch: Dict[tuple, Any]) -> Dict[tuple, Any]:
+        failed = {}
+        for (collection, key), value in batch.items():
+            try:
+                if value is _REMOVED:
+                    db.remove(collection, key)
+                else:
+                    db.set(collection, key, value)
+            except Exception:
+                failed[(collection, key)] = value
+        return failed
+
+    def flush(self):
+        dirty, self._dirty = self._dirty, {}
+        self._dirty.update(self._write(dirty))
+
+
+_store = _WriteBehindStore(PERSIST_MAX_DIRTY)
+atexit.register(_store.flush)
+
+
+class _GwebAcl:
+    def __init__(self):
+        self.enabled = set(_store.get(GWEB_SETTINGS, "enabled_users") or [])
+        self.disabled = set(_store.get(GWEB_SETTINGS, "disabled_users") or [])
+        self.for_all = bool(_store.get(GWEB_SETTINGS, "gweb_for_all") or False)
+
+    def allows(self, user_id: int) -> bool:
+        return user_id not in self.disabled and (self.for_all or user_id in self.enabled)
+
+    def _save(self, key: str, users: set):
+        _store.set(GWEB_SETTINGS, key, sorted(users))
+
+    def enable(self, user_id: int):
+        if user_id in self.disabled:
+            self.disabled.discard(user_id)
+            self._save("disabled_users", self.disabled)
+        if user_id not in self.enabled:
+            self.enabled.add(user_id)
+            self._save("enabled_users", self.enabled)
+
+    def disable(self, user_id: int):
+        if user_id not in self.disabled:
+            self.disabled.add(user_id)
+            self._save("disabled_users", self.disabled)
+        if user_id in self.enabled:
+            self.enabled.discard(user_id)
+            self._save("enabled_users", self.enabled)
+
+    def remove(self, user_id: int) -> bool:
+        changed = False
+        if user_id in self.enabled:
+            self.enabled.discard(user_id)
+            self._save("enabled_users", self.enabled)
+            changed = True
+        if user_id in self.disabled:
+            self.disabled.discard(user_id)
+            self._save("disabled_users", self.disabled)
+            changed = True
+        return changed
+
+    def toggle_all(self) -> bool:
+        self.for_all = not self.for_all
+        _store.set(GWEB_SETTINGS, "gweb_for_all", self.for_all)
+        return self.for_all
+
 
-_enabled_users = db.get(GWEB_SETTINGS, "enabled_users") or []
-_disabled_users = db.get(GWEB_SETTINGS, "disabled_users") or []
-_gweb_for_all = db.get(GWEB_SETTINGS, "gweb_for_all") or False
+_acl = _GwebAcl()
 
-_reply_queue: asyncio.Queue = asyncio.Queue()
-_reply_worker_started = False
+_stream_replies = bool(_store.get(GWEB_SETTINGS, "stream_replies", True))
+_supersede_replies = bool(_store.get(GWEB_SETTINGS, "supersede_replies", False))
 
 _smileys = ["-.-", "):", ":)", "*.*", ")*", ";)"]
-_sticker_buffer = defaultdict(list)
-_sticker_timers: Dict[int, asyncio.Task] = {}
 
-_gem_client = None
-_gem_client_lock = asyncio.Lock()
-_user_locks: Dict[int, asyncio.Lock] = {}
 
+def _normalize_gem_name(name: str) -> str:
+    return " ".join(name.split()).lower()
 
-async def _reply_worker(py_client: Client):
-    while True:
-        reply_func, args, kwargs = await _reply_queue.get()
+
+class _GemRegistry:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._by_id: Dict[str, Any] = {}
+        self._by_name: Dict[str, Any] = {}
+        self._fetched_at = 0.0
+        self._client = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._fetched_at = 0.0
+
+    def _fresh(self, gem_client) -> bool:
+        return self._client is gem_client and time.monotonic() - self._fetched_at < self.ttl
+
+    async def refresh(self, gem_client, force: bool = False):
+        if not force and self._fresh(gem_client):
+            return
+        async with self._lock:
+            if not force and self._fresh(gem_client):
+                return
+            await gem_client.fetch_gems(include_hidden=True)
+            by_id: Dict[str, Any] = {}
+            by_name: Dict[str, Any] = {}
+            for g in gem_client.gems:
+                by_id[g.id] = g
+                if g.name:
+                    by_name.setdefault(_normalize_gem_name(g.name), g)
+            self._by_id, self._by_name = by_id, by_name
+            self._client = gem_client
+            self._fetched_at = time.monotonic()
+
+    async def all(self, gem_client, force: bool = False) -> list:
+        await self.refresh(gem_client, force=force)
+        return list(self._by_id.values())
+
+    async def get(self, gem_client, gem_id: str):
+        await self.refresh(gem_client)
+        return self._by_id.get(gem_id)
+
+    async def resolve(self, gem_client, identifier: str):
+        await self.refresh(gem_client)
+        identifier = identifier.strip()
+        return self._by_id.get(identifier) or self._by_name.get(_normalize_gem_name(identifier))
+
+
+class _GeminiAccount:
+    __slots__ = ("key", "cookies", "client", "gems", "missing_gems", "lock", "active", "users", "failures", "backoff", "open_until", "probing", "epoch")
+
+    def __init__(self, key: str, cookies: Optional[dict] = None):
+        self.key = key
+        self.cookies = cookies
+        self.client = None
+        self.gems = _GemRegistry(GEM_CATALOG_TTL_SECONDS)
+        self.missing_gems: Dict[str, int] = {}
+        self.lock = asyncio.Lock()
+        self.active = 0
+        self.users = 0
+        self.failures = 0
+        self.backoff = 0.0
+        self.open_until: Optional[float] = None
+        self.probing = False
+        self.epoch = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.open_until is None or time.monotonic() >= self.open_until
+
+    def admit(self) -> Optional[tuple]:
+        if self.open_until is None:
+            return self.epoch, False
+        if self.probing or time.monotonic() < self.open_until:
+            return None
+        self.probing = True
+        return self.epoch, True
+
+    def record(self, ticket: tuple, ok: bool) -> bool:
+        epoch, probe = ticket
+        if epoch != self.epoch:
+            return False
+        if ok:
+            self.failures = 0
+            self.backoff = 0.0
+            self.open_until = None
+            self.probing = False
+            return False
+        self.failures += 1
+        if not probe and self.failures < BREAKER_FAILURE_THRESHOLD:
+            return False
+        self.backoff = min(BREAKER_BACKOFF_MAX, self.backoff * 2 or BREAKER_BACKOFF_BASE)
+        self.open_until = time.monotonic() + self.backoff / 2 + random.uniform(0, self.backoff / 2)
+        self.failures = 0
+        self.probing = False
+        self.epoch += 1
+        self._drop_client()
+        return True
+
+    def _drop_client(self):
+        client, self.client = self.client, None
+        if client is None or self.cookies is None:
+            return
+        try:
+            asyncio.create_task(client.close())
+        except Exception:
+            pass
+
+    async def get_client(self):
+        async with self.lock:
+            if self.client is None:
+                if self.cookies is None:
+                    self.client = await get_client()
+                else:
+                    client = GeminiClient(self.cookies["psid"], self.cookies.get("psidts"))
+                    await client.init(auto_close=False, auto_refresh=True)
+                    self.client = client
+            return self.client
+
+    async def has_gem(self, gem_id: str) -> bool:
+        try:
+            return await self.gems.get(await self.get_client(), gem_id) is not None
+        except Exception:
+            return False
+
+
+class _GeminiPool:
+    def __init__(self):
+        self.main = _GeminiAccount(POOL_MAIN_ACCOUNT)
+        self.accounts: Dict[str, _GeminiAccount] = {POOL_MAIN_ACCOUNT: self.main}
+        for cookies in _store.get(GWEB_SETTINGS, "accounts") or []:
+            self.accounts[cookies["key"]] = _GeminiAccount(cookies["key"], cookies)
+
+    def _save(self):
+        _store.set(GWEB_SETTINGS, "accounts", [a.cookies for a in self.accounts.values() if a.cookies])
+
+    def add(self, psid: str, psidts: Optional[str]) -> str:
+        key = uuid.uuid4().hex[:6]
+        self.accounts[key] = _GeminiAccount(key, {"key": key, "psid": psid, "psidts": psidts})
+        self._save()
+        return key
+
+    def remove(self, key: str) -> bool:
+        if key == POOL_MAIN_ACCOUNT or key not in self.accounts:
+            return False
+        self.accounts.pop(key)
+        self._save()
+        for state in _users.values():
+            if state.account == key:
+                state.account = None
+        return True
+
+    def _least_loaded(self) -> _GeminiAccount:
+        candidates = [a for a in self.accounts.values() if a.healthy] or list(self.accounts.values())
+        return min(candidates, key=lambda a: (a.active, a.users))
+
+    async def route(self, user_id: int) -> _GeminiAccount:
+        state = _users.get(user_id)
+        if state.account in self.accounts:
+            return self.accounts[state.account]
+        key = await _store.aget(GWEB_SETTINGS, f"user_account.{user_id}", None)
+        if key is None and await _store.aget(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}", None) is not None:
+            key = POOL_MAIN_ACCOUNT
+        account = self.accounts.get(key) if key else None
+        if account is None:
+            if key is not None:
+                _chat_sessions.discard(user_id)
+                _store.remove(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}")
+            account = self._least_loaded()
+            gem_id = await _store.aget(GWEB_SETTINGS, f"user_gem.{user_id}", None) or await _store.aget(GWEB_SETTINGS, "default_gem", None)
+            if gem_id and account is not self.main and not await account.has_gem(gem_id):
+                account = self.main
+            _store.set(GWEB_SETTINGS, f"user_account.{user_id}", account.key)
+        state.account = account.key
+        account.users += 1
+        return account
+
+    def mark(self, account: _GeminiAccount, ticket: tuple, ok: bool) -> bool:
+        return account.record(ticket, ok)
+
+    def report(self) -> str:
+        lines = []
+        for a in self.accounts.values():
+            if a.open_until is None:
+                state = "up"
+            elif a.probing:
+                state = "probing"
+            elif a.healthy:
+                state = "half-open"
+            else:
+                state = f"open {int(a.open_until - time.monotonic())}s (backoff {int(a.backoff)}s)"
+            lines.append(f"{a.key}: {state}, active {a.active}, users {a.users}")
+            if a.missing_gems:
+                missing = ", ".join(f"{gem_id} x{count}" for gem_id, count in a.missing_gems.items())
+                lines.append(f"  gems not on this account, chats started without them: {missing}")
+        return "\n".join(lines)
+
+
+_gem_pool = _GeminiPool()
+_gem_registry = _gem_pool.main.gems
+
+
+class _ChatSessionEntry:
+    __slots__ = ("chat", "client", "last_used")
+
+    def __init__(self, chat, client):
+        self.chat = chat
+        self.client = client
+        self.last_used = time.monotonic()
+
+
+class _ChatSessionCache:
+    def __init__(self, capacity: int, idle: float):
+        self.capacity = capacity
+        self.idle = idle
+        self._entries: "OrderedDict[int, _ChatSessionEntry]" = OrderedDict()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def _persist(self, user_id: int, entry: _ChatSessionEntry):
+        try:
+            _store.set(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}", entry.chat.metadata)
+        except Exception:
+            pass
+
+    def _sweep(self):
+        now = time.monotonic()
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.capacity and now - entry.last_used < self.idle:
+                break
+            self.evict(user_id)
+
+    def get(self, user_id: int, gem_client):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry.client is not gem_client:
+            self.evict(user_id)
+            return None
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(user_id)
+        return entry.chat
+
+    def adopt(self, user_id: int, chat, gem_client):
+        self._entries[user_id] = _ChatSessionEntry(chat, gem_client)
+        self._entries.move_to_end(user_id)
+        self._sweep()
+
+    def commit(self, user_id: int, chat, gem_client):
+        entry = self._entries.get(user_id)
+        if entry is None or entry.chat is not chat:
+            entry = self._entries[user_id] = _ChatSessionEntry(chat, gem_client)
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(user_id)
+        self._persist(user_id, entry)
+        self._sweep()
+
+    def evict(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._persist(user_id, entry)
+
+    def discard(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    def evict_all(self):
+        for user_id in list(self._entries):
+            self.evict(user_id)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_chat_sessions = _ChatSessionCache(CHAT_SESSION_CACHE_SIZE, CHAT_SESSION_IDLE_SECONDS)
+
+
+class _GapStats:
+    __slots__ = ("mean", "var", "last")
+
+    def __init__(self):
+        self.mean = COALESCE_INITIAL_GAP
+        self.var = (COALESCE_INITIAL_GAP / 2) ** 2
+        self.last: Optional[float] = None
+
+    def observe(self, now: float):
+        if self.last is not None:
+            gap = now - self.last
+            if gap < COALESCE_BURST_GAP:
+                diff = gap - self.mean
+                self.mean += COALESCE_GAP_ALPHA * diff
+                self.var = (1 - COALESCE_GAP_ALPHA) * (self.var + COALESCE_GAP_ALPHA * diff * diff)
+        self.last = now
+
+    def wait(self) -> float:
+        return min(DEFAULT_HISTORY_COMBINE_SECONDS, max(COALESCE_MIN_SECONDS, self.mean + 2 * self.var ** 0.5))
+
+
+class _UserState:
+    __slots__ = ("lock", "burst", "inflight", "gaps", "deadline", "started", "account", "last_seen")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.burst = None
+        self.inflight = None
+        self.gaps = _GapStats()
+        self.deadline: Optional[float] = None
+        self.started: Optional[float] = None
+        self.account: Optional[str] = None
+        self.last_seen = time.monotonic()
+
+    @property
+    def busy(self) -> bool:
+        return self.burst is not None or self.deadline is not None or self.lock.locked()
+
+    def footprint(self) -> int:
+        size = sys.getsizeof(self) + sys.getsizeof(self.gaps) + sys.getsizeof(self.lock)
+        if self.burst is not None:
+            size += sys.getsizeof(self.burst)
+            for field in (self.burst.texts, self.burst.files, self.burst.downloads, self.burst.stickers):
+                size += sys.getsizeof(field)
+            size += sum(sys.getsizeof(t) for t in self.burst.texts)
+        return size
+
+
+class _UserTable:
+    def __init__(self, capacity: int, idle: float):
+        self.capacity = capacity
+        self.idle = idle
+        self.evicted = 0
+        self._states: "OrderedDict[int, _UserState]" = OrderedDict()
+
+    def get(self, user_id: int) -> _UserState:
+        state = self._states.get(user_id)
+        if state is None:
+            state = self._states[user_id] = _UserState()
+        else:
+            self._states.move_to_end(user_id)
+        state.last_seen = time.monotonic()
+        self._sweep()
+        return state
+
+    def peek(self, user_id: int) -> Optional[_UserState]:
+        return self._states.get(user_id)
+
+    def values(self):
+        return self._states.values()
+
+    def _sweep(self):
+        now = time.monotonic()
+        excess = len(self._states) - self.capacity
+        stale = []
+        for user_id, state in self._states.items():
+            if excess <= 0 and now - state.last_seen < self.idle:
+                break
+            if not state.busy:
+                stale.append((user_id, state))
+                excess -= 1
+        for user_id, state in stale:
+            self._drop(user_id, state)
+
+    def _drop(self, user_id: int, state: _UserState):
+        del self._states[user_id]
+        self.evicted += 1
+        account = _gem_pool.accounts.get(state.account) if state.account else None
+        if account is not None:
+            account.users -= 1
+        _chat_sessions.evict(user_id)
+
+    def report(self) -> str:
+        busy = sum(1 for s in self._states.values() if s.busy)
+        size = sys.getsizeof(self._states) + sum(s.footprint() for s in self._states.values())
+        return (
+            f"users: {len(self._states)}/{self.capacity} (busy {busy}, evicted {self.evicted})\n"
+            f"idle eviction: {int(self.idle)}s\n"
+            f"state memory: ~{size / 1024:.1f} KiB\n"
+            f"chat sessions: {len(_chat_sessions)}/{_chat_sessions.capacity}"
+        )
+
+
+_users = _UserTable(USER_STATE_LIMIT, USER_STATE_IDLE_SECONDS)
+
+_MEDIA_EXTENSIONS = {
+    "document": ".bin",
+    "audio": ".mp3",
+    "video": ".mp4",
+    "voice": ".ogg",
+    "video_note": ".mp4",
+    "photo": ".jpg",
+}
+
+
+def _message_media(message: Message):
+    for attr, default_ext in _MEDIA_EXTENSIONS.items():
+        media_obj = getattr(message, attr, None)
+        if media_obj:
+            filename = getattr(media_obj, "file_name", None)
+            ext = Path(filename).suffix if filename else ""
+            return media_obj, ext or default_ext
+    return None, ""
+
+
+class _MediaCacheEntry:
+    __slots__ = ("path", "size", "refs")
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.refs = 0
+
+
+class _MediaCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, _MediaCacheEntry]" = OrderedDict()
+        self._by_path: Dict[str, str] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+        os.makedirs(root, exist_ok=True)
+        existing = sorted(os.scandir(root), key=lambda e: e.stat().st_mtime)
+        for item in existing:
+            if item.is_file():
+                self._add(Path(item.name).stem, item.path, item.stat().st_size)
+        self._evict()
+
+    def _add(self, unique_id: str, path: str, size: int) -> _MediaCacheEntry:
+        path = str(Path(path))
+        entry = self._entries[unique_id] = _MediaCacheEntry(path, size)
+        self._by_path[path] = unique_id
+        self.size += size
+        return entry
+
+    def _drop(self, unique_id: str):
+        entry = self._entries.pop(unique_id, None)
+        if entry is None:
+            return
+        self._by_path.pop(entry.path, None)
+        self.size -= entry.size
+        try:
+            if os.path.exists(entry.path):
+                os.remove(entry.path)
+        except Exception:
+            pass
+
+    def _evict(self, incoming: int = 0):
+        if self.size + incoming <= self.max_bytes:
+            return
+        for unique_id in [uid for uid, entry in self._entries.items() if entry.refs == 0]:
+            self._drop(unique_id)
+            if self.size + incoming <= self.max_bytes:
+                return
+
+    async def _download(self, py_client: Client, media_obj, unique_id: str, ext: str):
+        path = os.path.join(self.root, f"{unique_id}{ext}")
+        downloaded = await py_client.download_media(media_obj, file_name=path)
+        if not downloaded:
+            raise RuntimeError(f"download failed: {unique_id}")
+        size = os.path.getsize(downloaded)
+        self._evict(size)
+        self._add(unique_id, str(downloaded), size)
+
+    async def acquire(self, py_client: Client, media_obj, ext: str) -> Path:
+        unique_id = media_obj.file_unique_id
+        while True:
+            entry = self._entries.get(unique_id)
+            if entry is not None:
+                if os.path.exists(entry.path):
+                    entry.refs += 1
+                    self._entries.move_to_end(unique_id)
+                    return Path(entry.path)
+                self._drop(unique_id)
+            loading = self._loading.get(unique_id)
+            if loading is None:
+                loading = self._loading[unique_id] = asyncio.create_task(self._download(py_client, media_obj, unique_id, ext))
+                loading.add_done_callback(lambda _: self._loading.pop(unique_id, None))
+            await asyncio.shield(loading)
+
+    def release(self, paths: List[Path]):
+        for path in paths:
+            unique_id = self._by_path.get(str(path))
+            entry = self._entries.get(unique_id) if unique_id else None
+            if entry is None:
+                try:
+                    if path.exists():
+                        os.remove(path)
+                except Exception:
+                    pass
+                continue
+            entry.refs = max(0, entry.refs - 1)
+        self._evict()
+
+
+_media_cache = _MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+_download_slots = asyncio.Semaphore(MEDIA_DOWNLOAD_CONCURRENCY)
+
+
+async def _acquire_media(py_client: Client, media_obj, ext: str) -> Path:
+    async with _download_slots:
+        return await _media_cache.acquire(py_client, media_obj, ext)
+
+
+class _PacingController:
+    def __init__(self, global_rate: float, chat_rate: float):
+        self.global_rate = global_rate
+        self.default_chat_rate = chat_rate
+        self.chat_rates: Dict[Any, float] = {}
+        self.last_flood: Dict[Any, float] = {}
+        self.history = deque(maxlen=PACE_HISTORY_SIZE)
+
+    def global_interval(self) -> float:
+        return 1.0 / self.global_rate
+
+    def chat_interval(self, key) -> float:
+        return 1.0 / self.chat_rates.get(key, self.default_chat_rate)
+
+    def on_success(self, key):
+        self.global_rate = min(PACE_GLOBAL_MAX_RATE, self.global_rate + PACE_GLOBAL_STEP)
+        rate = self.chat_rates.get(key, self.default_chat_rate)
+        self.chat_rates[key] = min(PACE_CHAT_MAX_RATE, rate + PACE_CHAT_STEP)
+
+    def on_flood(self, key, seconds: int) -> bool:
+        now = time.time()
+        account_wide = any(k != key and now - at < PACE_ACCOUNT_FLOOD_WINDOW for at, k, _ in self.history)
+        if account_wide:
+            self.global_rate = max(PACE_GLOBAL_MIN_RATE, self.global_rate * PACE_BACKOFF)
+        rate = self.chat_rates.get(key, self.default_chat_rate)
+        self.chat_rates[key] = max(PACE_CHAT_MIN_RATE, rate * PACE_BACKOFF)
+        self.last_flood[key] = now
+        self.history.append((now, key, seconds))
+        return account_wide
+
+    def forget(self, key):
+        flooded = self.last_flood.get(key)
+        if flooded and time.time() - flooded < PACE_CHAT_MEMORY_SECONDS:
+            return
+        self.chat_rates.pop(key, None)
+        self.last_flood.pop(key, None)
+
+    def report(self) -> str:
+        now = time.time()
+        lines = [
+            f"Global: {self.global_rate:.2f} msg/s",
+            f"Default chat: {self.default_chat_rate:.2f} msg/s",
+            f"Tracked chats: {len(self.chat_rates)}",
+        ]
+        slowest = sorted(self.chat_rates.items(), key=lambda kv: kv[1])[:10]
+        for key, rate in slowest:
+            lines.append(f"  {key}: {rate:.2f} msg/s")
+        lines.append(f"FloodWaits: {len(self.history)}")
+        for at, key, seconds in reversed(self.history):
+            lines.append(f"  {int(now - at)}s ago · {key} · {seconds}s")
+        return "\n".join(lines)
+
+
+class _ReplyScheduler:
+    def __init__(self, pacing: _PacingController, lane_idle: float):
+        self.pacing = pacing
+        self.lane_idle = lane_idle
+        self._lanes: Dict[Any, asyncio.Queue] = {}
+        self._next_global = 0.0
+        self._py_client: Optional[Client] = None
+
+    def submit(self, key, item, py_client: Client):
+        self._py_client = py_client
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = asyncio.Queue()
+            asyncio.create_task(self._lane_worker(key, lane))
+        lane.put_nowait(item)
+
+    def pending(self, key) -> bool:
+        lane = self._lanes.get(key)
+        return lane is not None and not lane.empty()
+
+    async def acquire_budget(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_global)
+        self._next_global = slot + self.pacing.global_interval()
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def try_budget(self) -> bool:
+        now = asyncio.get_running_loop().time()
+        if self._next_global > now:
+            return False
+        self._next_global = now + self.pacing.global_interval()
+        return True
+
+    def _hold_global(self, seconds: float):
+        until = asyncio.get_running_loop().time() + seconds
+        self._next_global = max(self._next_global, until)
+
+    async def _lane_worker(self, key, lane: asyncio.Queue):
+        while True:
+            try:
+                reply_func, args, kwargs = await asyncio.wait_for(lane.get(), self.lane_idle)
+            except asyncio.TimeoutError:
+                if lane.empty():
+                    self._lanes.pop(key, None)
+                    self.pacing.forget(key)
+                    return
+                continue
+            await self.acquire_budget()
+            await self._deliver(key, reply_func, args, kwargs)
+            await asyncio.sleep(self.pacing.chat_interval(key))
+
+    async def _deliver(self, key, reply_func, args, kwargs):
+        py_client = self._py_client
         cleanup_file = kwargs.pop("cleanup_file", None)
+        result_future = kwargs.pop("result_future", None)
+        result = None
         try:
             try:
-                await reply_func(*args, **kwargs)
+                result = await reply_func(*args, **kwargs)
+                self.pacing.on_success(key)
             except FloodWait as e:
+                if self.pacing.on_flood(key, e.value):
+                    self._hold_global(e.value + 1)
                 try:
                     await py_client.send_message("me", f"FloodWait: sleeping {e.value}s")
                 except Exception:
                     pass
                 await asyncio.sleep(e.value + 1)
-                await reply_func(*args, **kwargs)
+                result = await reply_func(*args, **kwargs)
         except Exception as e:
             try:
                 await py_client.send_message("me", f"Reply queue error:\n{e}")
             except Exception:
                 pass
         finally:
+            if result_future and not result_future.done():
+                result_future.set_result(result)
             if cleanup_file:
-                try:
-                    if os.path.exists(cleanup_file):
-                        os.remove(cleanup_file)
-                except Exception:
-                    pass
-        await asyncio.sleep(2.1)
+                for path in [cleanup_file] if isinstance(cleanup_file, str) else cleanup_file:
+                    try:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    except Exception:
+                        pass
+
 
+_pacing = _PacingController(REPLY_GLOBAL_RATE, 1.0 / REPLY_CHAT_INTERVAL)
+_reply_scheduler = _ReplyScheduler(_pacing, REPLY_LANE_IDLE_SECONDS)
 
-def _ensure_reply_worker(py_client: Client):
-    global _reply_worker_started
-    if not _reply_worker_started:
-        asyncio.create_task(_reply_worker(py_client))
-        _reply_worker_started = True
+
+def _reply_lane_key(reply_func, args, kwargs):
+    if "chat_id" in kwargs:
+        return kwargs["chat_id"]
+    owner = getattr(reply_func, "__self__", None)
+    if isinstance(owner, Message) and owner.chat:
+        return owner.chat.id
+    return args[0] if args else None
 
 
 async def _queue_reply(reply_func, args, kwargs, py_client: Client):
-    _ensure_reply_worker(py_client)
     if isinstance(args, tuple):
         args = list(args)
-    await _reply_queue.put((reply_func, args, kwargs))
+    _reply_scheduler.submit(_reply_lane_key(reply_func, args, kwargs), (reply_func, args, kwargs), py_client)
+
+
+async def _call_reply(reply_func, args, kwargs, py_client: Client):
+    future = asyncio.get_running_loop().create_future()
+    await _queue_reply(reply_func, args, dict(kwargs, result_future=future), py_client)
+    return await future
 
 
 async def _safe_send_to_me(py_client: Client, text: str):
@@ -88,56 +931,454 @@ async def _safe_send_to_me(py_client: Client, text: str):
         pass
 
 
-async def _typing_task(py_client: Client, chat_id: int):
-    try:
-        try:
-            await py_client.send_chat_action(chat_id=chat_id, action=enums.ChatAction.TYPING)
-        except Exception:
-            pass
-        while True:
-            await asyncio.sleep(4)
+class _PresenceService:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._actions: Dict[int, List] = {}
+        self._due: Dict[int, float] = {}
+        self._py_client: Optional[Client] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+
+    def begin(self, py_client: Client, chat_id: int, action=enums.ChatAction.TYPING):
+        self._py_client = py_client
+        self._actions.setdefault(chat_id, []).append(action)
+        self._due[chat_id] = 0.0
+        self._wake.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def end(self, chat_id: int, action=enums.ChatAction.TYPING):
+        actions = self._actions.get(chat_id)
+        if not actions:
+            return
+        if action in actions:
+            actions.remove(action)
+        if actions:
+            self._due[chat_id] = 0.0
+        else:
+            self._actions.pop(chat_id, None)
+            self._due.pop(chat_id, None)
+        self._wake.set()
+
+    async def _run(self):
+        while self._actions:
+            self._wake.clear()
+            now = time.monotonic()
+            for chat_id, due in list(self._due.items()):
+                if due > now or chat_id not in self._actions:
+                    continue
+                self._due[chat_id] = now + self.interval
+                if _reply_scheduler.pending(chat_id):
+                    continue
+                if not _reply_scheduler.try_budget():
+                    self._due[chat_id] = now + PRESENCE_RETRY_SECONDS
+                    continue
+                actions = self._actions[chat_id]
+                try:
+                    await self._py_client.send_chat_action(chat_id=chat_id, action=actions[-1])
+                except Exception:
+                    pass
+            if not self._due:
+                break
             try:
-                await py_client.send_chat_action(chat_id=chat_id, action=enums.ChatAction.TYPING)
-            except Exception:
+                await asyncio.wait_for(self._wake.wait(), max(0.05, min(self._due.values()) - time.monotonic()))
+            except asyncio.TimeoutError:
                 pass
-    except asyncio.CancelledError:
-        return
 
 
-async def _get_gem_client():
-    global _gem_client
-    async with _gem_client_lock:
-        if _gem_client:
-            return _gem_client
+_presence = _PresenceService(PRESENCE_REFRESH_SECONDS)
+
+
+_SPLIT_SEPARATORS = ("\n\n", "\n", ". ", "! ", "? ", "; ", ", ", " ")
+_FENCE_CLOSE = "\n```"
+_FENCE_TAG_LIMIT = 32
+
+
+def _open_fence(text: str) -> str:
+    fence = ""
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line.startswith("```") or "```" in line[3:]:
+            continue
+        if fence:
+            fence = ""
+        else:
+            tag = line[3:].split(maxsplit=1)
+            tag = tag[0] if tag else ""
+            fence = "```" + (tag if len(tag) <= _FENCE_TAG_LIMIT else "")
+    return fence
+
+
+def _iter_text_parts(text: str, limit: int = TELEGRAM_TEXT_LIMIT):
+    carry = ""
+    rest = text.strip()
+    while rest:
+        head = carry + rest
+        if len(head) <= limit:
+            yield head
+            return
+        budget = limit - len(_FENCE_CLOSE)
+        window = head[:budget]
+        floor = max(len(carry), budget // 3)
+        cut = budget
+        for sep in _SPLIT_SEPARATORS:
+            pos = window.rfind(sep)
+            if pos > floor:
+                cut = pos + len(sep)
+                break
+        part = head[:cut].rstrip()
+        rest = head[cut:].lstrip("\n")
+        fence = _open_fence(part)
+        if fence and len(fence) + 1 < budget:
+            part += _FENCE_CLOSE
+            carry = fence + "\n"
+        else:
+            carry = ""
+        yield part
+
+
+class _StreamingReply:
+    __slots__ = ("py_client", "chat_id", "kwargs", "messages", "sending", "failed", "shown", "last_edit", "edit_task")
+
+    def __init__(self, py_client: Client, chat_id: int, reply_to: Optional[int]):
+        self.py_client = py_client
+        self.chat_id = chat_id
+        self.kwargs = {"reply_to_message_id": reply_to} if reply_to else {}
+        self.messages: List[Message] = []
+        self.sending = False
+        self.failed = False
+        self.shown: List[str] = []
+        self.last_edit = 0.0
+        self.edit_task: Optional[asyncio.Task] = None
+
+    async def _show(self, index: int, text: str, final: bool):
+        if index < len(self.shown) and self.shown[index] == text:
+            return
+        now = time.monotonic()
+        if index == len(self.messages):
+            kwargs = self.kwargs if index == 0 else {}
+            self.sending = True
+            message = await _call_reply(self.py_client.send_message, [self.chat_id, text], kwargs, self.py_client)
+            if message is None:
+                self.failed = True
+                return
+            self.messages.append(message)
+            self.shown.append(text)
+            self.last_edit = now
+            return
+        if self.edit_task and not self.edit_task.done():
+            if not final:
+                return
+            await self.edit_task
+        elif not final and now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self.shown[index] = text
+        self.last_edit = now
+        self.edit_task = asyncio.create_task(_call_reply(self.messages[index].edit_text, [text], {}, self.py_client))
+
+    async def update(self, text: str, final: bool = False):
+        if self.failed:
+            return
+        parts = list(_iter_text_parts(text))
+        for index, part in enumerate(parts):
+            await self._show(index, part, final or index < len(parts) - 1)
+            if self.failed:
+                return
+        if final:
+            for message in self.messages[len(parts):]:
+                await _queue_reply(message.delete, [], {}, self.py_client)
+
+    async def finish(self, text: str) -> bool:
+        if not self.messages:
+            return False
+        await self.update(text, final=True)
+        if self.failed:
+            parts = list(_iter_text_parts(text))
+            for index in range(min(len(self.messages), len(parts))):
+                await self._show(index, parts[index], True)
+            for message in self.messages[len(parts):]:
+                await _queue_reply(message.delete, [], {}, self.py_client)
+            for part in parts[len(self.messages):]:
+                await _queue_reply(self.py_client.send_message, [self.chat_id, part], {}, self.py_client)
+        if self.edit_task:
+            await self.edit_task
+        return True
+
+
+async def _fetch_generated_image(image: GeneratedImage, user_id: int):
+    name = f"gweb_gen_{user_id}_{uuid.uuid4().hex}.png"
+    path = os.path.join(TEMP_IMAGE_DIR, name)
+    buffer = BytesIO()
+    sink = buffer
+    try:
+        async with httpx.AsyncClient(follow_redirects=True, cookies=image.cookies, proxy=image.proxy) as http:
+            async with http.stream("GET", f"{image.url}=s2048") as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes():
+                    if sink is buffer and buffer.tell() + len(chunk) > IMAGE_SPILL_BYTES:
+                        sink = open(path, "wb")
+                        sink.write(buffer.getvalue())
+                    sink.write(chunk)
+    except Exception:
+        if sink is not buffer:
+            sink.close()
+        await image.save(path=TEMP_IMAGE_DIR, filename=name, verbose=False)
+        return path
+    if sink is not buffer:
+        sink.close()
+        return path
+    buffer.name = name
+    buffer.seek(0)
+    return buffer
+
+
+async def _queue_photos(py_client: Client, chat_id: int, photos: list, caption: Optional[str], reply_to: Optional[int], cleanup: List[str]):
+    for start in range(0, len(photos), MEDIA_GROUP_LIMIT):
+        chunk = photos[start:start + MEDIA_GROUP_LIMIT]
+        kwargs = {"reply_to_message_id": reply_to} if reply_to and start == 0 else {}
+        chunk_cleanup = [photo for photo in chunk if photo in cleanup]
+        if chunk_cleanup:
+            kwargs["cleanup_file"] = chunk_cleanup
+        chunk_caption = caption if start == 0 else None
+        if len(chunk) == 1:
+            if chunk_caption:
+                kwargs["caption"] = chunk_caption
+            await _queue_reply(py_client.send_photo, [chat_id, chunk[0]], kwargs, py_client)
+            continue
+        media = [InputMediaPhoto(photo) for photo in chunk]
+        if chunk_caption:
+            media[0].caption = chunk_caption
+        await _queue_reply(py_client.send_media_group, [chat_id, media], kwargs, py_client)
+
+
+async def _generate(chat, prompt: str, files_for_gem, streamer: Optional[_StreamingReply]):
+    send_stream = getattr(chat, "send_message_stream", None) if streamer else None
+    if send_stream is None:
+        response = await chat.send_message(prompt, files=files_for_gem)
+        return response, response.text or ""
+    response = None
+    text = ""
+    async for response in send_stream(prompt, files=files_for_gem):
+        delta = getattr(response, "text_delta", None)
+        text = text + delta if delta is not None else (response.text or "")
+        await streamer.update(text)
+    if response is None:
+        raise RuntimeError("empty Gemini stream")
+    return response, text or response.text or ""
+
+
+class _AdmissionController:
+    def __init__(self, limit: int, queue_limit: int):
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.active = 0
+        self.shed = 0
+        self._waiters: List[tuple] = []
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _shed_worst(self):
+        worst = max(self._waiters)
+        if worst[0] < PRIORITY_STRANGER:
+            return
+        self._waiters.remove(worst)
+        heapq.heapify(self._waiters)
+        worst[2].set_result(False)
+
+    async def acquire(self, priority: int) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_limit:
+            if priority >= PRIORITY_STRANGER:
+                self.shed += 1
+                return False
+            self._shed_worst()
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
         try:
-            _gem_client = await get_client()
-            return _gem_client
-        except Exception as e:
-            _gem_client = None
+            admitted = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.result():
+                self.release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
             raise
+        if not admitted:
+            self.shed += 1
+        return admitted
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
+
+    def report(self) -> str:
+        return f"Active: {self.active}/{self.limit}\nQueued: {self.queued}/{self.queue_limit}\nShed: {self.shed}"
+
 
+_admission = _AdmissionController(GEMINI_MAX_CONCURRENCY, GEMINI_QUEUE_LIMIT)
 
-async def _start_chat_for_user(gem_client, user_id: int):
-    user_gem = db.get(GWEB_SETTINGS, f"user_gem.{user_id}", None)
-    default_gem = db.get(GWEB_SETTINGS, "default_gem", None)
+
+def _admission_priority(user_id: int) -> int:
+    if user_id in _acl.enabled:
+        return PRIORITY_ENABLED
+    return PRIORITY_STRANGER
+
+
+async def _get_gem_client():
+    return await _gem_pool.main.get_client()
+
+
+async def _start_chat_for_user(account: _GeminiAccount, gem_client, user_id: int):
+    user_gem = await _store.aget(GWEB_SETTINGS, f"user_gem.{user_id}", None)
+    default_gem = await _store.aget(GWEB_SETTINGS, "default_gem", None)
     gem_to_use = user_gem or default_gem
-    meta = db.get(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}", None)
+    meta = await _store.aget(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}", None)
     try:
         if gem_to_use is not None:
             try:
-                await gem_client.fetch_gems(include_hidden=True)
+                if await account.gems.get(gem_client, gem_to_use) is None:
+                    account.missing_gems[gem_to_use] = account.missing_gems.get(gem_to_use, 0) + 1
+                    gem_to_use = None
             except Exception:
                 pass
         chat = gem_client.start_chat(metadata=meta, gem=gem_to_use) if gem_to_use else gem_client.start_chat(metadata=meta)
         return chat
     except Exception:
+        account.gems.invalidate()
         try:
-            db.remove(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}")
+            _store.remove(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}")
         except Exception:
             pass
         return gem_client.start_chat(gem=gem_to_use) if gem_to_use else gem_client.start_chat()
 
 
+async def _send_busy(py_client: Client, chat_id: int, reply_to: Optional[int]):
+    kwargs = {"reply_to_message_id": reply_to} if reply_to else {}
+    await _queue_reply(py_client.send_message, [chat_id, GEMINI_SHED_TEXT], kwargs, py_client)
+
+
+async def _admitted_generate(py_client: Client, user_id: int, chat_id: int, prompt: str, files: Optional[List[Path]], streamer: Optional[_StreamingReply], reply_to: Optional[int]):
+    account = await _gem_pool.route(user_id)
+    ticket = account.admit()
+    if ticket is None:
+        await _send_busy(py_client, chat_id, reply_to)
+        return None, "", None, None
+    try:
+        gem_client = await account.get_client()
+    except Exception as e:
+        _gem_pool.mark(account, ticket, False)
+        await _safe_send_to_me(py_client, f"❌ Gemini client error ({account.key}): {e}")
+        if account.open_until is not None:
+            await _send_busy(py_client, chat_id, reply_to)
+        return None, "", None, None
+
+    account.active += 1
+    try:
+        return await _generate_on(py_client, account, ticket, gem_client, user_id, chat_id, prompt, files, streamer, reply_to)
+    finally:
+        account.active -= 1
+        if ticket[1]:
+            account.probing = False
+
+
+async def _generate_on(py_client: Client, account: _GeminiAccount, ticket: tuple, gem_client, user_id: int, chat_id: int, prompt: str, files: Optional[List[Path]], streamer: Optional[_StreamingReply], reply_to: Optional[int]):
+    chat = _chat_sessions.get(user_id, gem_client)
+    if chat is None:
+        chat = await _start_chat_for_user(account, gem_client, user_id)
+        _chat_sessions.adopt(user_id, chat, gem_client)
+
+    files_for_gem = None
+    if files:
+        files_for_gem = [str(p) for p in files]
+
+    _presence.begin(py_client, chat_id)
+    try:
+        try:
+            response, bot_response = await _generate(chat, prompt or ".", files_for_gem, streamer)
+            await asyncio.sleep(0.25)
+        except Exception as e:
+            tripped = _gem_pool.mark(account, ticket, False)
+            err_text = str(e)
+            if account.open_until is not None:
+                if tripped:
+                    pause = int(account.open_until - time.monotonic())
+                    await _safe_send_to_me(py_client, f"❌ Gemini account {account.key} is failing, pausing requests for {pause}s: {err_text}")
+                await _send_busy(py_client, chat_id, reply_to)
+                return None, "", chat, gem_client
+            await _safe_send_to_me(py_client, f"❌ Gemini send error (will retry once): {err_text}")
+            _chat_sessions.discard(user_id)
+            try:
+                _store.remove(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}")
+            except Exception:
+                pass
+            try:
+                chat = gem_client.start_chat()
+                response, bot_response = await _generate(chat, prompt or ".", files_for_gem, streamer)
+            except Exception as e2:
+                _gem_pool.mark(account, ticket, False)
+                await _safe_send_to_me(py_client, f"❌ Gemini send failed after retry: {e2}")
+                if account.open_until is not None:
+                    await _send_busy(py_client, chat_id, reply_to)
+                return None, "", chat, gem_client
+    finally:
+        _presence.end(chat_id)
+    _gem_pool.mark(account, ticket, True)
+    return response, bot_response, chat, gem_client
+
+
+class _InFlight:
+    __slots__ = ("prompt", "files", "reply_to", "streamer", "task", "stale")
+
+    def __init__(self, prompt: str, files: Optional[List[Path]], reply_to: Optional[int]):
+        self.prompt = prompt
+        self.files = list(files) if files else None
+        self.reply_to = reply_to
+        self.streamer: Optional[_StreamingReply] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stale = False
+
+    def merge(self, prompt: str, files: Optional[List[Path]], reply_to: Optional[int]) -> bool:
+        if self.task is None or self.task.done() or (self.streamer is not None and self.streamer.sending):
+            return False
+        self.prompt = f"{self.prompt}\n{prompt}"
+        if files:
+            self.files = (self.files or []) + list(files)
+        self.reply_to = self.reply_to or reply_to
+        self.stale = True
+        self.task.cancel()
+        return True
+
+
+async def _generate_superseding(py_client: Client, user_id: int, chat_id: int, inflight: _InFlight):
+    while True:
+        inflight.stale = False
+        inflight.streamer = _StreamingReply(py_client, chat_id, inflight.reply_to) if _stream_replies else None
+        inflight.task = asyncio.create_task(_admitted_generate(py_client, user_id, chat_id, inflight.prompt, inflight.files, inflight.streamer, inflight.reply_to))
+        try:
+            await asyncio.wait({inflight.task})
+        except asyncio.CancelledError:
+            inflight.task.cancel()
+            raise
+        if not inflight.stale:
+            break
+        for message in inflight.streamer.messages if inflight.streamer else []:
+            await _queue_reply(message.delete, [], {}, py_client)
+    if inflight.task.cancelled():
+        return None, "", None, None
+    return inflight.task.result()
+
+
 async def _send_to_gemini(
     py_client: Client,
     user_id: int,
@@ -146,279 +1387,460 @@ async def _send_to_gemini(
     files: Optional[List[Path]],
     reply_to: Optional[int],
 ):
-    lock = _user_locks.setdefault(user_id, asyncio.Lock())
-    async with lock:
-        try:
-            gem_client = await _get_gem_client()
-        except Exception as e:
-            await _safe_send_to_me(py_client, f"❌ Gemini client error: {e}")
+    state = _users.get(user_id)
+    if _supersede_replies and state.inflight is not None and state.inflight.merge(prompt, files, reply_to):
+        return
+    async with state.lock:
+        if not await _admission.acquire(_admission_priority(user_id)):
+            await _send_busy(py_client, chat_id, reply_to)
+            if files:
+                _media_cache.release(files)
             return
+        inflight = state.inflight = _InFlight(prompt, files, reply_to)
+        try:
+            try:
+                response, bot_response, chat, gem_client = await _generate_superseding(py_client, user_id, chat_id, inflight)
+            finally:
+                state.inflight = None
+                _admission.release()
+            reply_to, streamer = inflight.reply_to, inflight.streamer
+            if response is None:
+                for message in streamer.messages if streamer else []:
+                    await _queue_reply(message.delete, [], {}, py_client)
+                return
 
-        chat = await _start_chat_for_user(gem_client, user_id)
+            _chat_sessions.commit(user_id, chat, gem_client)
 
-        files_for_gem = None
-        if files:
-            files_for_gem = [str(p) for p in files]
+            streamed = streamer is not None and await streamer.finish(bot_response)
 
-        typing = asyncio.create_task(_typing_task(py_client, chat_id))
-        try:
-            try:
-                response = await chat.send_message(prompt or ".", files=files_for_gem)
-                await asyncio.sleep(0.25)
-            except Exception as e:
-                err_text = str(e)
-                await _safe_send_to_me(py_client, f"❌ Gemini send error (will retry once): {err_text}")
-                try:
-                    db.remove(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}")
-                except Exception:
-                    pass
+            spilled = []
+
+            async def _resolve_image(image):
+                if isinstance(image, GeneratedImage):
+                    photo = await _fetch_generated_image(image, user_id)
+                    if isinstance(photo, str):
+                        spilled.append(photo)
+                    return photo
+                if isinstance(image, WebImage):
+                    return image.url
+                return None
+
+            images = getattr(response, "images", None) or []
+            if images:
+                _presence.begin(py_client, chat_id, enums.ChatAction.UPLOAD_PHOTO)
                 try:
-                    chat = gem_client.start_chat()
-                    response = await chat.send_message(prompt or ".", files=files_for_gem)
-                except Exception as e2:
-                    await _safe_send_to_me(py_client, f"❌ Gemini send failed after retry: {e2}")
-                    if files:
-                        for p in files:
-                            try:
-                                if p.exists():
-                                    os.remove(p)
-                            except Exception:
-                                pass
-                    return
+                    resolved = await asyncio.gather(*(_resolve_image(image) for image in images), return_exceptions=True)
+                finally:
+                    _presence.end(chat_id, enums.ChatAction.UPLOAD_PHOTO)
+            else:
+                resolved = []
+            photos = [photo for photo in resolved if photo and not isinstance(photo, BaseException)]
+
+            text_as_caption = bool(photos) and not streamed and len(bot_response) <= TELEGRAM_CAPTION_LIMIT
+            if photos:
+                caption = bot_response if text_as_caption else None
+                await _queue_photos(py_client, chat_id, photos, caption, reply_to, spilled)
+
+            if not streamed and not text_as_caption:
+                kwargs = {"reply_to_message_id": reply_to} if reply_to else {}
+                for part in _iter_text_parts(bot_response):
+                    await _queue_reply(py_client.send_message, [chat_id, part], kwargs, py_client)
+                    kwargs = {}
         finally:
-            typing.cancel()
-            try:
-                await typing
-            except Exception:
-                pass
+            if inflight.files:
+                _media_cache.release(inflight.files)
 
+
+async def _download_media_from_message(py_client: Client, message: Message) -> (List[Path], str):
+    files: List[Path] = []
+    caption = message.caption.strip() if message.caption else ""
+    media_obj, ext = _message_media(message)
+    if media_obj:
         try:
-            db.set(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}", chat.metadata)
+            files.append(await _acquire_media(py_client, media_obj, ext))
         except Exception:
             pass
+    return files, caption
 
-        bot_response = response.text or ""
 
-        if getattr(response, "images", None):
-            for i, image in enumerate(response.images):
+class _TimingWheel:
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick
+        self._slots: List[Dict[Any, tuple]] = [{} for _ in range(slots)]
+        self._where: Dict[Any, int] = {}
+        self._cursor = 0
+        self._cursor_time = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def _place(self, key, deadline: float, callback):
+        ticks = max(1, math.ceil((deadline - self._cursor_time) / self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot][key] = (deadline, callback)
+        self._where[key] = slot
+
+    def schedule(self, key, delay: float, callback):
+        self.cancel(key)
+        loop = asyncio.get_running_loop()
+        running = self._task is not None and not self._task.done()
+        if not running:
+            self._cursor_time = loop.time()
+        self._place(key, loop.time() + delay, callback)
+        if not running:
+            self._task = loop.create_task(self._run())
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            self._slots[slot].pop(key, None)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._where:
+            next_tick = self._cursor_time + self.tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            self._cursor_time = next_tick
+            bucket = self._slots[self._cursor]
+            if not bucket:
+                continue
+            horizon = loop.time() + self.tick / 2
+            for key, (deadline, callback) in list(bucket.items()):
+                del bucket[key]
+                del self._where[key]
+                if deadline > horizon:
+                    self._place(key, deadline, callback)
+                    continue
                 try:
-                    if isinstance(image, GeneratedImage):
-                        fp = os.path.join(TEMP_IMAGE_DIR, f"gweb_gen_{user_id}_{i}.png")
-                        await image.save(path=TEMP_IMAGE_DIR, filename=f"gweb_gen_{user_id}_{i}.png", verbose=True)
-                        await _queue_reply(py_client.send_photo, [chat_id, fp], {"reply_to_message_id": reply_to, "cleanup_file": fp}, py_client)
-                    elif isinstance(image, WebImage):
-                        await _queue_reply(py_client.send_photo, [chat_id, image.url], {"reply_to_message_id": reply_to}, py_client)
+                    callback()
                 except Exception:
                     pass
 
-        kwargs = {"reply_to_message_id": reply_to} if reply_to else {}
-        await _queue_reply(py_client.send_message, [chat_id, bot_response], kwargs, py_client)
 
-        if files:
-            for p in files:
-                try:
-                    if p.exists():
-                        os.remove(p)
-                except Exception:
-                    pass
+_wheel = _TimingWheel(WHEEL_TICK, WHEEL_SLOTS)
 
+_album_gap = MEDIA_GROUP_TAIL_MIN / MEDIA_GROUP_TAIL_FACTOR
 
-async def _download_media_from_message(py_client: Client, message: Message) -> (List[Path], str):
-    files: List[Path] = []
-    caption = message.caption.strip() if message.caption else ""
-    for attr in ["document", "audio", "video", "voice", "video_note"]:
-        media_obj = getattr(message, attr, None)
-        if media_obj:
-            filename = getattr(media_obj, "file_name", None)
-            ext_map = {
-                "voice": ".ogg",
-                "video_note": ".mp4",
-                "video": ".mp4",
-                "audio": ".mp3",
-                "document": ".bin",
-            }
-            ext = Path(filename).suffix if filename else ext_map.get(attr, ".bin")
-            path = os.path.join(TEMP_FILE_DIR, f"{media_obj.file_unique_id}{ext}")
-            try:
-                await message.download(path)
-                files.append(Path(path))
-            except Exception:
-                pass
-            return files, caption
 
-    if message.photo:
-        path = os.path.join(TEMP_FILE_DIR, f"{message.photo.file_unique_id}.jpg")
-        try:
-            await message.download(path)
-            files.append(Path(path))
-        except Exception:
-            pass
-    return files, caption
+class _MediaGroup:
+    __slots__ = ("entries", "expected", "last_arrival", "max_gap")
 
+    def __init__(self):
+        self.entries: List[dict] = []
+        self.expected: Optional[int] = None
+        self.last_arrival: Optional[float] = None
+        self.max_gap = 0.0
 
-@Client.on_message((filters.sticker | filters.animation) & filters.private & ~filters.me & ~filters.bot, group=1)
-async def _sticker_handler(client: Client, message: Message):
-    user = message.from_user
-    if not user:
-        return
-    user_id = user.id
-    global _enabled_users, _disabled_users, _gweb_for_all
-    _enabled_users = db.get(GWEB_SETTINGS, "enabled_users") or _enabled_users
-    _disabled_users = db.get(GWEB_SETTINGS, "disabled_users") or _disabled_users
-    _gweb_for_all = db.get(GWEB_SETTINGS, "gweb_for_all") or _gweb_for_all
+    def add(self, entry: dict):
+        now = time.monotonic()
+        if self.last_arrival is not None:
+            self.max_gap = max(self.max_gap, now - self.last_arrival)
+        self.last_arrival = now
+        self.entries.append(entry)
 
-    if user_id in _disabled_users or (not _gweb_for_all and user_id not in _enabled_users):
-        return
+    @property
+    def complete(self) -> bool:
+        return self.expected is not None and len(self.entries) >= self.expected
 
-    meta = db.get(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}", None)
-    if meta is None:
-        try:
-            await _send_to_gemini(client, user_id, message.chat.id, "Hello", None, None)
-        except Exception as e:
-            await _safe_send_to_me(client, f"❌ gweb sticker seed error: {e}")
-        return
+    def tail(self) -> float:
+        gap = max(self.max_gap, _album_gap)
+        return min(MEDIA_GROUP_TAIL_MAX, max(MEDIA_GROUP_TAIL_MIN, gap * MEDIA_GROUP_TAIL_FACTOR))
 
-    _sticker_buffer[user_id].append(message)
-    if _sticker_timers.get(user_id):
-        _sticker_timers[user_id].cancel()
 
-    async def _process_sticker_buffer(uid: int):
-        await asyncio.sleep(8)
-        msgs = _sticker_buffer.pop(uid, [])
-        _sticker_timers.pop(uid, None)
-        if not msgs:
-            return
-        last_msg = msgs[-1]
-        await asyncio.sleep(random.uniform(2, 6))
-        try:
-            await _queue_reply(client.send_message, [last_msg.chat.id, random.choice(_smileys)], {}, client)
-        except Exception:
-            pass
+def _schedule_media_group(client: Client, media_group_id: str, group: _MediaGroup):
+    delay = 0 if group.complete else group.tail()
+    _wheel.schedule(("album", media_group_id), delay, lambda: asyncio.create_task(_flush_media_group(client, media_group_id, group)))
 
-    _sticker_timers[user_id] = asyncio.create_task(_process_sticker_buffer(user_id))
 
+async def _probe_media_group(client: Client, media_group_id: str, group: _MediaGroup, message: Message):
+    try:
+        album = await client.get_media_group(message.chat.id, message.id)
+    except Exception:
+        return
+    group.expected = len(album)
+    if group.complete and client.media_buffer.get(media_group_id) is group:
+        _schedule_media_group(client, media_group_id, group)
 
-@Client.on_message(filters.text & filters.private & ~filters.me & ~filters.bot, group=1)
-async def _text_handler(client: Client, message: Message):
-    user = message.from_user
-    if not user:
+
+async def _flush_media_group(client: Client, media_group_id: str, group: _MediaGroup):
+    global _album_gap
+    while True:
+        pending = [e["download"] for e in group.entries if e.get("download") and not e["download"].done()]
+        if not pending:
+            break
+        await asyncio.wait(pending)
+    if client.media_buffer.get(media_group_id) is not group:
         return
-    user_id = user.id
-    user_name = user.first_name or "User"
-    global _enabled_users, _disabled_users, _gweb_for_all
-    _enabled_users = db.get(GWEB_SETTINGS, "enabled_users") or _enabled_users
-    _disabled_users = db.get(GWEB_SETTINGS, "disabled_users") or _disabled_users
-    _gweb_for_all = db.get(GWEB_SETTINGS, "gweb_for_all") or _gweb_for_all
-
-    if user_id in _disabled_users or (not _gweb_for_all and user_id not in _enabled_users):
+    client.media_buffer.pop(media_group_id, None)
+    if group.max_gap:
+        _album_gap += MEDIA_GROUP_GAP_ALPHA * (group.max_gap - _album_gap)
+    entries = sorted(group.entries, key=lambda e: e["reply_to"])
+    if not entries:
         return
+    owner = entries[0].get("owner")
+    burst = _burst_for(owner, entries[0].get("chat_id"))
+    for e in entries:
+        download = e.get("download")
+        if not download:
+            continue
+        if download.exception():
+            await _safe_send_to_me(client, f"❌ media download error: {download.exception()}")
+            continue
+        burst.files.append(download.result())
+    caption_text = next((e.get("caption") for e in entries if e.get("caption")), "")
+    if caption_text:
+        burst.texts.append(caption_text)
+    burst.reply_to = burst.reply_to or entries[0].get("reply_to")
+    _schedule_media_burst(client, owner)
+
+
+class _TextCoalescer:
+    def __init__(self, users: _UserTable):
+        self.users = users
+
+    def on_message(self, user_id: int):
+        now = time.monotonic()
+        state = self.users.get(user_id)
+        state.gaps.observe(now)
+        if state.started is None:
+            state.started = now
+        state.deadline = now + state.gaps.wait()
+
+    def on_media(self, user_id: int):
+        state = self.users.get(user_id)
+        if state.deadline is not None:
+            return
+        state.started = time.monotonic()
+        state.deadline = state.started + COALESCE_MIN_SECONDS
+
+    def on_action(self, user_id: int, action):
+        state = self.users.peek(user_id)
+        if state is None or state.deadline is None:
+            return
+        now = time.monotonic()
+        if isinstance(action, raw.types.SendMessageCancelAction):
+            state.deadline = min(state.deadline, now + COALESCE_MIN_SECONDS)
+        else:
+            state.deadline = max(state.deadline, now + COALESCE_TYPING_HOLD)
 
-    if not hasattr(client, "gweb_buffer"):
-        client.gweb_buffer = {}
-        client.gweb_timers = {}
+    def remaining(self, user_id: int) -> float:
+        state = self.users.peek(user_id)
+        if state is None or state.deadline is None:
+            return 0.0
+        return min(state.deadline, state.started + COALESCE_MAX_HOLD) - time.monotonic()
 
-    if user_id not in client.gweb_buffer:
-        client.gweb_buffer[user_id] = []
-        client.gweb_timers[user_id] = None
+    def done(self, user_id: int):
+        state = self.users.peek(user_id)
+        if state is not None:
+            state.deadline = None
+            state.started = None
 
-    client.gweb_buffer[user_id].append(message.text.strip())
 
-    if client.gweb_timers[user_id]:
-        client.gweb_timers[user_id].cancel()
+_coalescer = _TextCoalescer(_users)
 
-    async def _process_text_buffer(msg: Message):
-        await asyncio.sleep(DEFAULT_HISTORY_COMBINE_SECONDS)
-        texts = client.gweb_buffer.pop(user_id, [])
-        client.gweb_timers[user_id] = None
-        if not texts:
-            return
-        combined = "\n".join(t.strip() for t in texts if t and t.strip())
-        await asyncio.sleep(random.choice([1, 2, 3]))
-        files = []
-        if message.reply_to_message:
-            files, cap = await _download_media_from_message(client, message.reply_to_message)
-            if cap:
-                combined = f"{cap}\n\n{combined}"
-        reply_to = message.reply_to_message.id if message.reply_to_message and files else None
-        await _send_to_gemini(client, user_id, message.chat.id, combined or ".", files or None, reply_to)
 
-    client.gweb_timers[user_id] = asyncio.create_task(_process_text_buffer(message))
+class _Burst:
+    __slots__ = ("chat_id", "texts", "files", "downloads", "stickers", "reply_to", "anchor")
 
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.texts: List[str] = []
+        self.files: List[Path] = []
+        self.downloads: List[asyncio.Task] = []
+        self.stickers: List[Message] = []
+        self.reply_to: Optional[int] = None
+        self.anchor: Optional[Message] = None
 
-@Client.on_message(filters.private & ~filters.me & ~filters.bot, group=1)
-async def _file_handler(client: Client, message: Message):
-    user = message.from_user
-    if not user:
+
+def _burst_for(user_id: int, chat_id: int) -> _Burst:
+    state = _users.get(user_id)
+    if state.burst is None:
+        state.burst = _Burst(chat_id)
+    return state.burst
+
+
+def _arm_burst(client: Client, user_id: int):
+    _wheel.schedule(("burst", user_id), _coalescer.remaining(user_id), lambda: _on_burst_due(client, user_id))
+
+
+def _on_burst_due(client: Client, user_id: int):
+    if _coalescer.remaining(user_id) > 0:
+        _arm_burst(client, user_id)
         return
-    user_id = user.id
-    user_name = user.first_name or "User"
-    global _enabled_users, _disabled_users, _gweb_for_all
-    _enabled_users = db.get(GWEB_SETTINGS, "enabled_users") or _enabled_users
-    _disabled_users = db.get(GWEB_SETTINGS, "disabled_users") or _disabled_users
-    _gweb_for_all = db.get(GWEB_SETTINGS, "gweb_for_all") or _gweb_for_all
-
-    if user_id in _disabled_users or (not _gweb_for_all and user_id not in _enabled_users):
+    state = _users.peek(user_id)
+    burst = state.burst if state else None
+    if state is not None:
+        state.burst = None
+    _coalescer.done(user_id)
+    if burst is not None:
+        asyncio.create_task(_flush_burst(client, user_id, burst))
+
+
+def _schedule_burst(client: Client, user_id: int):
+    _coalescer.on_message(user_id)
+    _arm_burst(client, user_id)
+
+
+def _schedule_media_burst(client: Client, user_id: int):
+    _coalescer.on_media(user_id)
+    _arm_burst(client, user_id)
+
+
+def _sticker_note(message: Message) -> str:
+    if message.sticker:
+        return f"[sticker {message.sticker.emoji}]" if message.sticker.emoji else "[sticker]"
+    return "[GIF]"
+
+
+async def _flush_burst(client: Client, user_id: int, burst: _Burst):
+    if burst.downloads:
+        await asyncio.wait(burst.downloads)
+
+    files = list(burst.files)
+    for download in burst.downloads:
+        if download.exception():
+            await _safe_send_to_me(client, f"❌ media download error: {download.exception()}")
+            continue
+        files.append(download.result())
+    texts = [t for t in burst.texts if t]
+
+    if not texts and not files:
+        if burst.stickers:
+            await asyncio.sleep(random.uniform(2, 6))
+            await _queue_reply(client.send_message, [burst.chat_id, random.choice(_smileys)], {}, client)
         return
 
-    caption = message.caption.strip() if message.caption else ""
+    combined = "\n".join(texts + [_sticker_note(m) for m in burst.stickers])
+    reply_to = burst.reply_to
+    anchor = burst.anchor
+    if anchor and anchor.reply_to_message:
+        quoted, cap = await _download_media_from_message(client, anchor.reply_to_message)
+        if cap:
+            combined = f"{cap}\n\n{combined}"
+        if quoted:
+            files.extend(quoted)
+            reply_to = reply_to or anchor.reply_to_message.id
+    await _send_to_gemini(client, user_id, burst.chat_id, combined or ".", files or None, reply_to)
+
+
+async def _route_sticker(client: Client, message: Message, user_id: int):
+    if user_id not in _chat_sessions and await _store.aget(GWEB_HISTORY_COLLECTION, f"chat_metadata.{user_id}", None) is None:
+        try:
+            await _send_to_gemini(client, user_id, message.chat.id, "Hello", None, None)
+        except Exception as e:
+            await _safe_send_to_me(client, f"❌ gweb sticker seed error: {e}")
+        return
 
-    if message.media_group_id:
-        if not hasattr(client, "media_buffer"):
-            client.media_buffer = defaultdict(list)
-            client.media_timers = {}
+    burst = _burst_for(user_id, message.chat.id)
+    burst.stickers.append(message)
+    _schedule_burst(client, user_id)
 
-        if message.photo:
-            path = await client.download_media(message.photo)
-        else:
-            path = await client.download_media(message.document or message.video or message.audio or message.voice or message.video_note)
 
-        client.media_buffer[message.media_group_id].append({"path": path, "caption": caption, "reply_to": message.id, "owner": user_id, "chat_id": message.chat.id})
+async def _route_text(client: Client, message: Message, user_id: int):
+    if not message.text:
+        return
+    burst = _burst_for(user_id, message.chat.id)
+    burst.texts.append(message.text.strip())
+    if message.reply_to_message:
+        burst.anchor = message
+    _schedule_burst(client, user_id)
 
-        if client.media_timers.get(message.media_group_id):
-            client.media_timers[message.media_group_id].cancel()
 
-        async def _process_media_group(media_group_id: str):
-            await asyncio.sleep(3)
-            entries = client.media_buffer.pop(media_group_id, [])
-            client.media_timers.pop(media_group_id, None)
-            if not entries:
-                return
-            files = [Path(e["path"]) for e in entries if e.get("path")]
-            reply_to = entries[0].get("reply_to")
-            owner = entries[0].get("owner")
-            chat_id = entries[0].get("chat_id")
-            caption_text = ""
-            for e in entries:
-                if e.get("caption"):
-                    caption_text = e.get("caption")
-                    break
-            prompt = caption_text or "."
-            await _send_to_gemini(client, owner, chat_id, prompt, files, reply_to)
-
-        client.media_timers[message.media_group_id] = asyncio.create_task(_process_media_group(message.media_group_id))
+async def _route_media(client: Client, message: Message, user_id: int):
+    media_obj, ext = _message_media(message)
+    if not media_obj:
         return
+    burst = _burst_for(user_id, message.chat.id)
+    burst.downloads.append(asyncio.create_task(_acquire_media(client, media_obj, ext)))
+    if message.caption:
+        burst.texts.append(message.caption.strip())
+    burst.reply_to = burst.reply_to or message.id
+    _schedule_media_burst(client, user_id)
+
+
+async def _route_album(client: Client, message: Message, user_id: int):
+    if not hasattr(client, "media_buffer"):
+        client.media_buffer = {}
+
+    media_group_id = message.media_group_id
+    group = client.media_buffer.get(media_group_id)
+    if group is None:
+        group = client.media_buffer[media_group_id] = _MediaGroup()
+        asyncio.create_task(_probe_media_group(client, media_group_id, group, message))
+
+    media_obj, ext = _message_media(message)
+    download = asyncio.create_task(_acquire_media(client, media_obj, ext)) if media_obj else None
+    caption = message.caption.strip() if message.caption else ""
 
-    file_path = None
-    try:
-        if message.video or message.video_note:
-            file_path = await client.download_media(message.video or message.video_note)
-        elif message.audio or message.voice:
-            file_path = await client.download_media(message.audio or message.voice)
-        elif message.document and message.document.file_name.endswith(".pdf"):
-            file_path = await client.download_media(message.document)
-        elif message.document:
-            file_path = await client.download_media(message.document)
-        elif message.photo:
-            file_path = await client.download_media(message.photo)
-        else:
-            return
-    except Exception as e:
-        await _safe_send_to_me(client, f"❌ media download error: {e}")
+    group.add({"download": download, "caption": caption, "reply_to": message.id, "owner": user_id, "chat_id": message.chat.id})
+    _schedule_media_group(client, media_group_id, group)
+
+
+class _RecentMessages:
+    def __init__(self, ttl: float, limit: int):
+        self.ttl = ttl
+        self.limit = limit
+        self.hits = 0
+        self._seen: "OrderedDict[tuple, float]" = OrderedDict()
+
+    def seen(self, chat_id: int, message_id: int) -> bool:
+        now = time.monotonic()
+        while self._seen:
+            oldest = next(iter(self._seen.values()))
+            if now - oldest < self.ttl and len(self._seen) < self.limit:
+                break
+            self._seen.popitem(last=False)
+        key = (chat_id, message_id)
+        if key in self._seen:
+            self.hits += 1
+            return True
+        self._seen[key] = now
+        return False
+
+    def report(self) -> str:
+        return f"duplicate updates dropped: {self.hits} (tracking {len(self._seen)} recent messages)"
+
+
+_recent = _RecentMessages(RECENT_UPDATE_TTL_SECONDS, RECENT_UPDATE_LIMIT)
+
+_ROUTES = {(None, False): _route_text, (enums.MessageMediaType.WEB_PAGE, False): _route_text}
+for _kind in (enums.MessageMediaType.STICKER, enums.MessageMediaType.ANIMATION):
+    _ROUTES[(_kind, False)] = _route_sticker
+for _kind in (
+    enums.MessageMediaType.PHOTO,
+    enums.MessageMediaType.DOCUMENT,
+    enums.MessageMediaType.AUDIO,
+    enums.MessageMediaType.VIDEO,
+    enums.MessageMediaType.VOICE,
+    enums.MessageMediaType.VIDEO_NOTE,
+):
+    _ROUTES[(_kind, False)] = _route_media
+    _ROUTES[(_kind, True)] = _route_album
+
+
+@Client.on_message(filters.private & ~filters.me & ~filters.bot, group=1)
+async def _private_dispatch(client: Client, message: Message):
+    route = _ROUTES.get((message.media, message.media_group_id is not None))
+    if route is None:
+        return
+    user = message.from_user
+    if not user or not _acl.allows(user.id):
+        return
+    if _recent.seen(message.chat.id, message.id):
         return
+    await route(client, message, user.id)
 
-    files = [Path(file_path)] if file_path else None
-    prompt = caption or "."
-    await _send_to_gemini(client, user_id, message.chat.id, prompt, files, message.id)
+
+@Client.on_raw_update(group=1)
+async def _typing_handler(client: Client, update, users, chats):
+    if isinstance(update, raw.types.UpdateUserTyping):
+        _coalescer.on_action(update.user_id, update.action)
+        state = _users.peek(update.user_id)
+        if state is not None and state.burst is not None:
+            _arm_burst(client, update.user_id)
+    raise ContinuePropagation
 
 
 @Client.on_message(filters.command(["gwrole"], prefix) & filters.me)
@@ -429,7 +1851,8 @@ async def _gwrole(client: Client, message: Message):
         if len(parts) == 1:
             # clear for current chat
             target_id = message.chat.id
-            db.remove(GWEB_SETTINGS, f"user_gem.{target_id}")
+            _store.remove(GWEB_SETTINGS, f"user_gem.{target_id}")
+            _chat_sessions.evict(target_id)
             await _queue_reply(message.edit_text, [f"Role reset"], {}, client)
             await _queue_reply(message.delete, [], {}, client)
             return
@@ -443,36 +1866,26 @@ async def _gwrole(client: Client, message: Message):
 
         gem_identifier = gem_identifier.strip()
         if not gem_identifier:
-            db.remove(GWEB_SETTINGS, f"user_gem.{target}")
+            _store.remove(GWEB_SETTINGS, f"user_gem.{target}")
+            _chat_sessions.evict(target)
             await _queue_reply(message.edit_text, [f"Role reset: {target}"], {}, client)
             await _queue_reply(message.delete, [], {}, client)
             return
 
         try:
             gem_client = await _get_gem_client()
-            await gem_client.fetch_gems(include_hidden=True)
+            gem_obj = await _gem_registry.resolve(gem_client, gem_identifier)
         except Exception as e:
             await _safe_send_to_me(client, f"❌ failed to get gem client: {e}")
             return
 
-        gem_obj = None
-        try:
-            gem_obj = gem_client.gems.get(id=gem_identifier)
-        except Exception:
-            gem_obj = None
-
-        if not gem_obj:
-            for g in gem_client.gems:
-                if g.name and g.name.strip().lower() == gem_identifier.strip().lower():
-                    gem_obj = g
-                    break
-
         if not gem_obj:
             await _queue_reply(message.edit_text, [f"Gem not found: {gem_identifier}"], {}, client)
             await _queue_reply(message.delete, [], {}, client)
             return
 
-        db.set(GWEB_SETTINGS, f"user_gem.{target}", gem_obj.id)
+        _store.set(GWEB_SETTINGS, f"user_gem.{target}", gem_obj.id)
+        _chat_sessions.evict(target)
         await _queue_reply(message.edit_text, [f"Gem for {target} set to: {gem_obj.name} ({gem_obj.id})"], {}, client)
         await _queue_reply(message.delete, [], {}, client)
     except Exception as e:
@@ -484,52 +1897,63 @@ async def _gweb_admin(client: Client, message: Message):
     try:
         parts = message.text.strip().split()
         if len(parts) < 2:
-            await _queue_reply(message.edit_text, ["Usage: gweb [on|off|del|all|r] [user_id]"], {}, client)
+            await _queue_reply(message.edit_text, ["Usage: gweb [on|off|del|all|r|pace|persist|dbasync|stream|supersede|load|acc|mem] [user_id]"], {}, client)
             return
         cmd = parts[1].lower()
         target = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else message.chat.id
 
-        global _enabled_users, _disabled_users, _gweb_for_all
-        _enabled_users = db.get(GWEB_SETTINGS, "enabled_users") or _enabled_users
-        _disabled_users = db.get(GWEB_SETTINGS, "disabled_users") or _disabled_users
-        _gweb_for_all = db.get(GWEB_SETTINGS, "gweb_for_all") or _gweb_for_all
-
         if cmd == "on":
-            if target in _disabled_users:
-                _disabled_users.remove(target)
-                db.set(GWEB_SETTINGS, "disabled_users", _disabled_users)
-            if target not in _enabled_users:
-                _enabled_users.append(target)
-                db.set(GWEB_SETTINGS, "enabled_users", _enabled_users)
+            _acl.enable(target)
             await _queue_reply(message.edit_text, [f"<spoiler>ON: {target}</spoiler>"], {}, client)
         elif cmd == "off":
-            if target not in _disabled_users:
-                _disabled_users.append(target)
-                db.set(GWEB_SETTINGS, "disabled_users", _disabled_users)
-            if target in _enabled_users:
-                _enabled_users.remove(target)
-                db.set(GWEB_SETTINGS, "enabled_users", _enabled_users)
+            _acl.disable(target)
             await _queue_reply(message.edit_text, [f"<spoiler>OFF: {target}</spoiler>"], {}, client)
         elif cmd == "del":
-            db.remove(GWEB_HISTORY_COLLECTION, f"chat_metadata.{target}")
+            _chat_sessions.discard(target)
+            _store.remove(GWEB_HISTORY_COLLECTION, f"chat_metadata.{target}")
             await _queue_reply(message.edit_text, [f"<spoiler>Deleted: {target}</spoiler>"], {}, client)
         elif cmd == "all":
-            _gweb_for_all = not _gweb_for_all
-            db.set(GWEB_SETTINGS, "gweb_for_all", _gweb_for_all)
-            await _queue_reply(message.edit_text, [f"All: {'enabled' if _gweb_for_all else 'disabled'}"], {}, client)
+            for_all = _acl.toggle_all()
+            await _queue_reply(message.edit_text, [f"All: {'enabled' if for_all else 'disabled'}"], {}, client)
         elif cmd == "r":
-            changed = False
-            if target in _enabled_users:
-                _enabled_users.remove(target)
-                db.set(GWEB_SETTINGS, "enabled_users", _enabled_users)
-                changed = True
-            if target in _disabled_users:
-                _disabled_users.remove(target)
-                db.set(GWEB_SETTINGS, "disabled_users", _disabled_users)
-                changed = True
+            changed = _acl.remove(target)
             await _queue_reply(message.edit_text, [f"<spoiler>Removed: {target}</spoiler>" if changed else f"<spoiler>Not found: {target}</spoiler>"], {}, client)
+        elif cmd == "persist":
+            if len(parts) > 2 and parts[2].isdigit():
+                _store.set_interval(int(parts[2]))
+            mode = f"every {_store.interval}s" if _store.interval > 0 else "write-through"
+            await _queue_reply(message.edit_text, [f"Persist: {mode}, pending: {_store.pending}"], {}, client)
+        elif cmd == "acc":
+            sub = parts[2].lower() if len(parts) > 2 else ""
+            if sub == "add" and len(parts) > 3:
+                key = _gem_pool.add(parts[3], parts[4] if len(parts) > 4 else None)
+                await _queue_reply(message.edit_text, [f"Account added: {key}"], {}, client)
+            elif sub == "del" and len(parts) > 3:
+                removed = _gem_pool.remove(parts[3])
+                await _queue_reply(message.edit_text, [f"Account removed: {parts[3]}" if removed else f"Account not found: {parts[3]}"], {}, client)
+            else:
+                await _safe_send_to_me(client, f"gweb accounts:\n\n{_gem_pool.report()}")
+        elif cmd == "mem":
+            await _safe_send_to_me(client, f"gweb memory:\n\n{_users.report()}")
+        elif cmd == "load":
+            await _safe_send_to_me(client, f"gweb load:\n\n{_admission.report()}\n{_recent.report()}")
+        elif cmd == "supersede":
+            global _supersede_replies
+            _supersede_replies = not _supersede_replies
+            _store.set(GWEB_SETTINGS, "supersede_replies", _supersede_replies)
+            await _queue_reply(message.edit_text, [f"Supersede: {'enabled' if _supersede_replies else 'disabled'}"], {}, client)
+        elif cmd == "stream":
+            global _stream_replies
+            _stream_replies = not _stream_replies
+            _store.set(GWEB_SETTINGS, "stream_replies", _stream_replies)
+            await _queue_reply(message.edit_text, [f"Streaming: {'enabled' if _stream_replies else 'disabled'}"], {}, client)
+        elif cmd == "dbasync":
+            _adb.set_enabled(not _adb.enabled)
+            await _queue_reply(message.edit_text, [f"DB thread: {'enabled' if _adb.enabled else 'disabled'}"], {}, client)
+        elif cmd == "pace":
+            await _safe_send_to_me(client, f"gweb pacing:\n\n{_pacing.report()}")
         else:
-            await _queue_reply(message.edit_text, ["Usage: gweb [on|off|del/all/r] [user_id]"], {}, client)
+            await _queue_reply(message.edit_text, ["Usage: gweb [on|off|del/all/r/pace/persist/dbasync/stream/supersede/load/acc/mem] [user_id]"], {}, client)
 
         await _queue_reply(message.delete, [], {}, client)
     except Exception as e:
@@ -545,13 +1969,12 @@ async def _setgw(client: Client, message: Message):
         if sub is None:
             try:
                 gem_client = await _get_gem_client()
-                await gem_client.fetch_gems(include_hidden=True)
-                all_gems = list(gem_client.gems)
+                all_gems = await _gem_registry.all(gem_client, force=True)
                 custom_gems = [g for g in all_gems if not getattr(g, "predefined", False)]
                 if not custom_gems:
                     await message.edit_text("No custom gems found for this account.")
                     return
-                default_id = db.get(GWEB_SETTINGS, "default_gem") or ""
+                default_id = await _store.aget(GWEB_SETTINGS, "default_gem") or ""
                 lines = []
                 for i, g in enumerate(custom_gems, start=1):
                     gid = getattr(g, "id", "") or ""
@@ -565,11 +1988,10 @@ async def _setgw(client: Client, message: Message):
 
         if sub == "role":
             if len(tokens) == 2:
-                current = db.get(GWEB_SETTINGS, "default_gem") or "None"
+                current = await _store.aget(GWEB_SETTINGS, "default_gem") or "None"
                 try:
                     gem_client = await _get_gem_client()
-                    await gem_client.fetch_gems(include_hidden=True)
-                    gem_obj = gem_client.gems.get(id=current) if current != "None" else None
+                    gem_obj = await _gem_registry.get(gem_client, current) if current != "None" else None
                     name = gem_obj.name if gem_obj else current
                     await message.edit_text(f"Current default gem: {name}")
                 except Exception:
@@ -579,21 +2001,12 @@ async def _setgw(client: Client, message: Message):
             gem_identifier = " ".join(tokens[2:])
             try:
                 gem_client = await _get_gem_client()
-                await gem_client.fetch_gems(include_hidden=True)
-                gem_obj = None
-                try:
-                    gem_obj = gem_client.gems.get(id=gem_identifier)
-                except Exception:
-                    gem_obj = None
-                if not gem_obj:
-                    for g in gem_client.gems:
-                        if g.name and g.name.strip().lower() == gem_identifier.strip().lower():
-                            gem_obj = g
-                            break
+                gem_obj = await _gem_registry.resolve(gem_client, gem_identifier)
                 if not gem_obj:
                     await message.edit_text(f"Gem not found: {gem_identifier}")
                     return
-                db.set(GWEB_SETTINGS, "default_gem", gem_obj.id)
+                _store.set(GWEB_SETTINGS, "default_gem", gem_obj.id)
+                _chat_sessions.evict_all()
                 await message.edit_text(f"Default gem set to: {gem_obj.name} ({gem_obj.id})")
             except Exception as e:
                 await message.edit_text(f"Failed to set default gem: {e}")
@@ -606,6 +2019,14 @@ async def _setgw(client: Client, message: Message):
 
 modules_help["gweb"] = {
     "gweb on/off/del/all/r [user_id]": "Manage gweb auto-replies for users.",
+    "gweb pace": "Show the learned reply send rate and recent FloodWait history.",
+    "gweb persist [seconds]": "Show or set how often buffered chat/settings writes are flushed to the DB (0 = write every change immediately).",
+    "gweb acc [add <__Secure-1PSID> [__Secure-1PSIDTS] | del <key>]": "List, add or remove extra Gemini web accounts and show their circuit breaker state. New users are routed to the least-loaded healthy account and stay on it.",
+    "gweb mem": "Show how many users gweb keeps state for, how many were evicted for being idle and roughly how much memory that state uses.",
+    "gweb load": "Show Gemini admission control: running requests, queued requests, how many were shed and how many redelivered updates were dropped.",
+    "gweb stream": "Toggle streaming replies: send the first part of Gemini's answer early and edit it as the rest arrives.",
+    "gweb supersede": "Toggle superseding: if a user writes again before Gemini has answered, the pending request is dropped and one merged prompt is sent instead.",
+    "gweb dbasync": "Toggle running gweb DB reads/writes on a dedicated thread instead of directly on the event loop.",
     "setgw / setgweb": "List custom gems and set global default gem or per-chat via gwrole. Usage: setgw, setgw role <GemNameOrId>",
     "Auto-reply to private messages": "Uses gemini_webapi (cookie-based) to reply and saves per-user Gemini chat metadata (no local transcript). Supports buffered messages, sticker/GIF buffering, typing actions and sending images returned by Gemini.",
 }